@@ -1,8 +1,22 @@
 import os
 import hashlib
+import re
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    # blake3 is several times faster than md5 and the hash is only used
+    # for content addressing, not security
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Part head fields in one compiled scan each, the match loop runs in C
+# Content-Disposition: form-data; name="csrfmiddlewaretoken"; filename="file.png"
+_CONTENT_DISPOSITION_RE = re.compile(rb'name="(?P<name>[^"]*)"(?:[^\r\n]*filename="(?P<filename>[^"]*)")?')
+_CONTENT_TYPE_RE = re.compile(rb'Content-Type:\s*(?P<content_type>[^\r\n]+)')
+
 
 class MultiPartStreamerException(Exception):
     def __init__(self, message):
@@ -13,11 +27,12 @@ class MultiPartStreamerException(Exception):
 class MultiPartStreamer:
     class MyBuffer:
         def __init__(self, part_name):
-            self.buffer = b''
+            # bytearray gives amortized O(1) append, bytes += copies whole buffer every write
+            self.buffer = bytearray()
             self.part_name = part_name
 
         def write(self, chunk):
-            self.buffer += chunk
+            self.buffer.extend(chunk)
 
         def close(self):
             pass
@@ -29,39 +44,63 @@ class MultiPartStreamer:
             return f'MyBuffer {self.part_name} {self.buffer}'
 
     class MyFile:
-        def __init__(self, upload_dir, part_name, part_filename, part_filename_ext):
-            self.file = self._create_file(upload_dir)
+        def __init__(self, upload_dir, part_name, part_filename, part_filename_ext, io_pool):
             self.part_filename_ext = part_filename_ext
+            self.file = self._create_file(upload_dir)
             self.form_file_name = part_filename
             self.from_field_name = part_name
             self.dirname = upload_dir
             self.filename = None
-            self.md5hash = None
-            self.md5 = hashlib.md5()
+            self.content_hash = None
+            # usedforsecurity=False skips the OpenSSL FIPS policy check per context
+            self.hasher = blake3.blake3() if blake3 is not None else hashlib.new('md5', usedforsecurity=False)
+            self.io_pool = io_pool
+            self.pending_writes = []
+            # coalesce small parser chunks before they hit the pool and the file
+            self.write_buffer = bytearray()
+            self.write_buffer_limit = 1 << 20
 
         def _create_file(self, upload_dir):
-            while True:
-                log_id = str(uuid.uuid4())
-                new_file_name = f'{log_id}.{self.part_filename_ext}'
-                if not os.path.exists(new_file_name):
-                    break
+            # uuid4 collision is not a real event, no need to stat before create
+            new_file_name = f'{uuid.uuid4()}.{self.part_filename_ext}'
+
+            # 1 MiB write buffer, default 8 KiB costs a syscall per few chunks
+            return open(upload_dir / new_file_name, 'wb', buffering=1 << 20)
 
-            return open(upload_dir / new_file_name, 'wb')
+        def _flush_write_buffer(self):
+            if self.write_buffer:
+                data = bytes(self.write_buffer)
+                self.write_buffer.clear()
+                self.pending_writes.append(self.io_pool.submit(self.file.write, data))
 
         def write(self, chunk):
-            self.md5.update(chunk)
-            self.file.write(chunk)
+            # the hash releases the GIL on large buffers, so hashing here
+            # overlaps with disk writes queued on the pool thread
+            self.hasher.update(chunk)
+            # extend copies out of the parser buffer, which is shifted after
+            # write returns
+            self.write_buffer.extend(chunk)
+            if len(self.write_buffer) >= self.write_buffer_limit:
+                self._flush_write_buffer()
 
         def close(self):
+            self._flush_write_buffer()
+
+            # surface write errors before the file is finalized
+            for future in self.pending_writes:
+                future.result()
+            self.pending_writes = []
+
             self.file.close()
-            self.md5hash = self.md5.hexdigest()
-            self.filename = f'{self.md5hash}.{self.part_filename_ext}'
+            # truncate to 32 hex chars so blake3 names keep the md5 format
+            self.content_hash = self.hasher.hexdigest()[:32]
+            self.filename = f'{self.content_hash}.{self.part_filename_ext}'
 
-            file = Path(self.file.name)
-            file.rename(Path(self.dirname) / f'{self.filename}')
+            # atomic and skips building two Path objects per close
+            os.replace(self.file.name, os.path.join(str(self.dirname), self.filename))
 
             self.file = None
-            self.md5 = None
+            self.hasher = None
 
         def value(self):
             return self.filename
@@ -71,7 +110,13 @@ class MultiPartStreamer:
 
     def __init__(self, allowed_file_content_types: list, allowed_file_extensions: list, upload_dir: Path):
         self.boundary = None
-        self.prev_chunk = b''
+        # encoded boundary patterns, filled once by apply_content_type
+        self._boundary_open = None
+        self._boundary_open_re = None
+        self._boundary_mid = None
+        self._boundary_last = None
+        # Single sliding buffer, process() appends and scanners consume from the front
+        self._buf = bytearray()
         self.parts = {}
         self.current_part_name = None
         self.mode = 0
@@ -79,59 +124,62 @@ class MultiPartStreamer:
         self.upload_dir = upload_dir
         self.allowed_file_content_types = allowed_file_content_types
         self.allowed_file_extensions = allowed_file_extensions
+        # single worker keeps file writes in submission order
+        self.io_pool = ThreadPoolExecutor(max_workers=1)
 
-    def _head_parser(self, head):
-        splitted = head.split(b'\r\n')
-        content_disposition = splitted[0]
-        if len(splitted) > 1:
-            content_type = splitted[1]
-        else:
-            content_type = b''
-
-        return content_disposition, content_type
+    def _parse_head(self, head):
+        part_name = part_filename = part_type = ''
 
-    def _content_type_parser(self, content_type):
-        value = b''
+        match = _CONTENT_DISPOSITION_RE.search(head)
+        if match:
+            part_name = match.group('name').decode()
+            if match.group('filename') is not None:
+                part_filename = match.group('filename').decode()
 
-        key = b'Content-Type: '
-        key_len = len(key)
+        match = _CONTENT_TYPE_RE.search(head)
+        if match:
+            part_type = match.group('content_type').decode()
 
-        start = content_type.find(key)
-        if start != -1:
-            value = content_type[key_len:]
+        return part_name, part_filename, part_type
 
-        return value.decode()
+    def _write_range(self, part, start, end):
+        # Payload goes to the sink as memoryview, md5.update, file.write and
+        # bytearray.extend all take buffer-protocol objects without a copy.
+        # The view is released right away so the buffer can be shifted after
+        with memoryview(self._buf) as mv:
+            part.write(mv[start:end])
 
-    def _content_disposition_parser(self, content_disposition, field):
-        # Content-Disposition: form-data; name="csrfmiddlewaretoken"
-        value = b''
+    def _process_chunk_from_start(self):
+        boundary = self._boundary_open
+        boundary_last = self._boundary_last
 
-        key = str.encode(field) + b'="'
-        key_len = len(key)
+        boundary_len = len(boundary)
 
-        start = content_disposition.find(key)
-        if start != -1:
-            tail = content_disposition[start + key_len:]
-            end = tail.find(b'"')
-            value = tail[:end]
+        buf = self._buf
 
-        return value.decode()
+        # Walk boundary offsets instead of split, split allocates every part
+        # body as a separate bytes object at once. finditer keeps the match
+        # loop in compiled regex code, the Python body below runs per part
+        starts = [match.start() for match in self._boundary_open_re.finditer(buf)]
 
-    def _process_chunk_from_start(self, next_chunk):
-        boundary = str.encode(f'--{self.boundary}\r\n')
-        boundary_last = str.encode(f'\r\n--{self.boundary}--\r\n')
+        consumed = 0
+        for i, boundary_start in enumerate(starts):
+            start = boundary_start + boundary_len
+            is_last = i == len(starts) - 1
+            next_start = -1 if is_last else starts[i + 1]
+            end = len(buf) if is_last else next_start
 
-        double_chunk = self.prev_chunk + next_chunk
-        splitted = double_chunk.split(boundary)[1:]
+            index = buf.find(b'\r\n\r\n', start, end)
+            if index == -1:
+                # Head not complete yet, keep boundary and head buffered until next chunk
+                consumed = boundary_start
+                break
 
-        for idx, s in enumerate(splitted):
-            index = s.find(b'\r\n\r\n')
-            head = s[:index]
-            tail = s[index + 4:]
+            head = bytes(buf[start:index])
+            data_start = index + 4
 
-            content_disposition, content_type = self._head_parser(head)
-            part_name = self._content_disposition_parser(content_disposition, 'name')
-            part_type = self._content_type_parser(content_type) or self.default_content_type
+            part_name, part_filename, part_type = self._parse_head(head)
+            part_type = part_type or self.default_content_type
 
             if not part_name:
                 raise MultiPartStreamerException('Form field name required')
@@ -139,8 +187,6 @@ class MultiPartStreamer:
             self.current_part_name = part_name
 
             if part_type in self.allowed_file_content_types:
-                part_filename = self._content_disposition_parser(content_disposition, 'filename')
-
                 if not part_filename:
                     raise MultiPartStreamerException('Form filename required')
 
@@ -154,81 +200,92 @@ class MultiPartStreamer:
                         raise MultiPartStreamerException('Allowed file extension: ' + str(self.allowed_file_extensions))
 
                 # Store file as new form part
-                self.parts[part_name] = self.MyFile(self.upload_dir, part_name, part_filename, part_filename_ext)
+                part = self.MyFile(self.upload_dir, part_name, part_filename, part_filename_ext, self.io_pool)
             elif part_type == self.default_content_type:
                 # Store buffer as new form part
-                self.parts[part_name] = self.MyBuffer(part_name)
+                part = self.MyBuffer(part_name)
             else:
                 raise MultiPartStreamerException('Allowed file content-type: ' + str(self.allowed_file_content_types))
 
+            # part kept in a local, no need to rehash part_name on every use
+            self.parts[part_name] = part
+
             # when no brake abowe
-            if tail[-len(boundary_last):] == boundary_last:
+            # endswith compares in place, a tail slice would allocate per chunk
+            if is_last and buf.endswith(boundary_last):
                 # Finish current part and whole form
-                self.parts[part_name].write(tail[:-len(boundary_last)])
-                self.parts[part_name].close()
-                self.prev_chunk = b''
+                self._write_range(part, data_start, len(buf) - len(boundary_last))
+                part.close()
+                consumed = len(buf)
             else:
-                # When not last block in splitted
-                if idx != len(splitted) - 1:
-                    # Save part
-                    self.parts[part_name].write(tail[:-len(b'\r\n')])
+                # When next boundary already found part is complete
+                if not is_last:
+                    # Save part without trailing \r\n before next boundary
+                    self._write_range(part, data_start, next_start - len(b'\r\n'))
+                    part.close()
+                    consumed = next_start
                 else:
                     # Calculate with next chunk
-                    self.prev_chunk = tail
+                    consumed = data_start
                     self.mode = 1
 
-    def _process_chunk_from_prev(self, next_chunk):
-        boundary_mid = str.encode(f'\r\n--{self.boundary}\r\n')
-        boundary_last = str.encode(f'\r\n--{self.boundary}--\r\n')
+        # Single shift of unconsumed tail instead of rebuilding prev + next
+        if consumed:
+            del buf[:consumed]
+
+    def _process_chunk_from_prev(self):
+        boundary_mid = self._boundary_mid
+        boundary_last = self._boundary_last
 
         # if boundary_last last was not found in mode 0 then continue find
         # boundary or boundary_last in mode 1
-        part_name = self.current_part_name
-        double_chunk = self.prev_chunk + next_chunk
-        boundary_index = double_chunk.find(boundary_mid)
+        part = self.parts[self.current_part_name]
+        buf = self._buf
+        boundary_index = buf.find(boundary_mid)
 
         if boundary_index != -1:
-            # Case when start of boundary at end of prev_chunk and end of boundary at start of next_chunk
-            # ----PREV_CHUNK-----
-            # BBBBBBBBBBBB--BOUND
-            # ----NEXT_CHUNK-----
-            # ARY--BBBBBBBBBBBBBB
-            # ----DOUBLE_CHUNK----
+            # Case when boundary found in buffered body, even if it was split across chunks
+            # -------BUF--------
             # BBBBBBBBBBBB--BOUNDARY--BBBBBBBBBBBBBB
             # ^___save___^____preapre_to_mode_0____^
 
             # finish current part and start read next file
-            self.parts[part_name].write(double_chunk[:boundary_index])
-            self.parts[part_name].close()
+            self._write_range(part, 0, boundary_index)
+            part.close()
             # boundary_index + is shift for process_chunk_from_start like as first chunk
-            self.prev_chunk = double_chunk[boundary_index + len('\r\n'):]
+            del buf[:boundary_index + len('\r\n')]
             # unset file body loop
             self.mode = 0
-        elif double_chunk[-len(boundary_last):] == boundary_last:
-            # Case when whole boundary at end of double_chunk, also that mean end of form
-            # ----double_chunk-----
+        elif buf.endswith(boundary_last):
+            # Case when whole boundary at end of buf, also that mean end of form
+            # --------BUF----------
             # BBBB--BOUNDARY_LAST--
 
             # finish current part and whole form
-            self.parts[part_name].write(double_chunk[:-len(boundary_last)])
-            self.parts[part_name].close()
-            self.prev_chunk = b''
+            self._write_range(part, 0, len(buf) - len(boundary_last))
+            part.close()
+            buf.clear()
         else:
             # Case when boundary and boundary_last not found in part
-            # ----double_chunk-----
+            # --------BUF----------
             # BBBBBBBBBBBBBBBBBBBBB
 
-            # part not finishd, save current and wait next call data_received
-            self.parts[part_name].write(self.prev_chunk)
-            self.prev_chunk = next_chunk
+            # part not finishd, flush all except tail where boundary may be split
+            # across chunks and wait next call data_received
+            flush = len(buf) - (len(boundary_last) - 1)
+            if flush > 0:
+                self._write_range(part, 0, flush)
+                del buf[:flush]
 
     def process(self, next_chunk):
         try:
+            self._buf.extend(next_chunk)
+
             if self.mode == 0:
-                self._process_chunk_from_start(next_chunk)
+                self._process_chunk_from_start()
 
             elif self.mode == 1:
-                self._process_chunk_from_prev(next_chunk)
+                self._process_chunk_from_prev()
 
         except MultiPartStreamerException:
             raise
@@ -239,12 +296,30 @@ class MultiPartStreamer:
             except Exception:
                 raise MultiPartStreamerException(f'Can\'t close {self.current_part_name} on process exception occur')
 
+    def _finalize(self):
+        buf = self._buf
+        if not buf:
+            return
+
+        if self.mode == 1:
+            # residual bytes belong to the current part body, write them out
+            # directly instead of re-running the head parser over them
+            part = self.parts[self.current_part_name]
+            end = len(buf)
+            if buf.endswith(self._boundary_last):
+                end -= len(self._boundary_last)
+            self._write_range(part, 0, end)
+            part.close()
+            self.mode = 0
+        else:
+            self._process_chunk_from_start()
+
+        buf.clear()
+
     def values(self):
         # Do not call until last self.process was called, usualy it mean call in tornado.web.RequestHandler.post
         # Since unknow point to last self.process call must flush data before get values
-        if self.prev_chunk:
-            self._process_chunk_from_start(self.prev_chunk)
-            self.prev_chunk = b''
+        self._finalize()
 
         return {k: self.parts[k].value() for k in self.parts}
 
@@ -257,6 +332,11 @@ class MultiPartStreamer:
 
             if from_format and from_format == 'multipart/form-data':
                 self.boundary = from_boundary
+                # encode boundary patterns once per request instead of per chunk
+                self._boundary_open = f'--{from_boundary}\r\n'.encode()
+                self._boundary_open_re = re.compile(re.escape(self._boundary_open))
+                self._boundary_mid = f'\r\n--{from_boundary}\r\n'.encode()
+                self._boundary_last = f'\r\n--{from_boundary}--\r\n'.encode()
             else:
                 raise ValueError
 